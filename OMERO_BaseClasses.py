@@ -6,42 +6,80 @@ from omero.gateway import BlitzGateway
 from omero.rtypes import rlong, robject, rstring, rtime, wrap, unwrap
 
 import sys
+import time
+import logging
+import datetime
+import queue
 import itertools
+import threading
 import numpy as np
 
+from concurrent.futures import ThreadPoolExecutor
+
+
+logger = logging.getLogger(__name__)
+
 
 class OMERO_Object:
     """
     Generic base class for an OMERO connection.
     """
     
+    # Number of rows fetched per request by query()
+    page_size = 1000
+    
     def __init__ (self, *args, **kwargs): 
         self.args = args
         self.kwargs = kwargs
         
         self.server = "littlestar.camm.usc.edu"
         self.port = 4064
+        self.workers = 8
         
         for key,value in self.kwargs.items():
             if   key == "username": self.username = value
             elif key == "password": self.password = value
             elif key == "server":   self.server = value
             elif key == "port":     self.port = value
+            elif key == "workers":  self.workers = value
         
         if (self.username is None): raise ValueError("Cannot connect: No username.")
         if (self.password is None): raise ValueError("Cannot connect: No password.")
         
+        # BlitzGateway sessions must not be used by two threads at the same time,
+        # so each thread gets its own (see also prefetch_planes()).
+        # Every connection opened is tracked so that they can be closed later
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
         self.connect()
     
+    @property
+    def conn (self):
+        "The OMERO connection of the current thread, connecting on first use"
+        if getattr(self._local, 'conn', None) is None:
+            self.connect()
+        return self._local.conn
+    
     def connect (self):
-        "Initiate a connection to the OMERO server"
-        self.conn = BlitzGateway(   username=self.username, 
-                                    passwd=self.password, 
-                                    host=self.server, 
-                                    port=self.port)
-        self.connected = self.conn.connect()
+        "Initiate a connection to the OMERO server for the current thread"
+        self._local.conn = BlitzGateway(username=self.username, 
+                                        passwd=self.password, 
+                                        host=self.server, 
+                                        port=self.port)
+        with self._connections_lock:
+            self._connections.append(self._local.conn)
+        self.connected = self._local.conn.connect()
         if self.connected is False:
             raise IOError("OMERO connection {user}@{server}:{port} failed.".format(user=self.username, server=self.server, port=self.port))
+    
+    def close_connections (self, keep=None):
+        "Close every connection opened by connect(), except 'keep'"
+        with self._connections_lock:
+            connections, self._connections = self._connections, [ keep ] if keep is not None else []
+        for conn in connections:
+            if conn is not keep:
+                conn.close()
 
     def _reconnect (f):
         "Decorator for re-connecting if the connection times out"
@@ -81,7 +119,7 @@ class OMERO_Object:
         """
         # Init some variables
         noqc = False
-        parameters = omero.sys.Parameters()
+        parameters = omero.sys.ParametersI()
         
         # Parse out query parameters from kwargs
         for key,value in kwargs.items():
@@ -94,8 +132,9 @@ class OMERO_Object:
                     raise ValueError("Expected list type for 'daterange' parameter")
                 if not isinstance(value[0], datetime.datetime) or not isinstance(value[1], datetime.datetime):
                     raise ValueError("Expected datetime type for 'daterange' entry")
-                parameters.map.update({ 'startDate':    rtime(time.mktime(value[0].timetuple())),
-                                        'endDate':      rtime(time.mktime(value[1].timetuple())) })
+                # OMERO times are in milliseconds since the epoch
+                parameters.map.update({ 'startDate':    rtime(int(time.mktime(value[0].timetuple()) * 1000)),
+                                        'endDate':      rtime(int(time.mktime(value[1].timetuple()) * 1000)) })
             elif key in ('filename', 'plate', 'acquisition', 'with_tag', 'without_tag'):
                 parameters.map.update({ key:rstring(value) })
             else:
@@ -107,23 +146,32 @@ class OMERO_Object:
         
         # Build the where clause
         where = []
-        if 'without_tag' in kwargs: where.append("image not in ( {} )".format(self.__tag_query()))
+        if 'without_tag' in kwargs: where.append("image not in ( {} )".format(self.__tag_query('without_tag')))
         if 'acquisition' in kwargs: where.append("image in ( {} )".format(self.__acquisition_query()))
         if 'daterange' in kwargs:   where.append("image in ( {} )".format(self.__date_query()))
         if 'filename' in kwargs:    where.append("image in ( {} )".format(self.__filename_query()))
-        if 'with_tag' in kwargs:    where.append("image in ( {} )".format(self.__tag_query()))
+        if 'with_tag' in kwargs:    where.append("image in ( {} )".format(self.__tag_query('with_tag')))
         if 'plate' in kwargs:       where.append("image in ( {} )".format(self.__plate_query()))
         if noqc:                    where.append("image in ( {} )".format(self.__noqc_query()))
         
-        # Construct the query
-        query = "select image from Image image where " + " and ".join(where)
+        # Construct the query, projecting only the image ID's and
+        # ordered so that the pages are stable
+        query = "select image.id from Image image where " + " and ".join(where) + " order by image.id"
         
-        # Get the results
+        # Get the results one page at a time
         queryService = self.getQueryService()
-        results = queryService.findAllByQuery(query, params)
+        ids = []
+        offset = 0
+        while True:
+            parameters.page(offset, self.page_size)
+            results = queryService.projection(query, parameters)
+            ids.extend(row[0].val for row in results)
+            if len(results) < self.page_size:
+                break
+            offset += self.page_size
         
         # Return image ID's
-        return [ image.id for image in results ]
+        return ids
     
     def __noqc_query (self):
         return """  select image from Image image
@@ -156,11 +204,12 @@ class OMERO_Object:
                     left outer join image.details.creationEvent as event
                     where event.time between :startDate and :endDate"""
     
-    def __tag_query (self):
+    def __tag_query (self, parameter):
+        "Tag subquery bound to the named parameter 'parameter'"
         return """  select image from Image image
                     left outer join image.annotationLinks as annotations 
                     left outer join annotations.child as annotation 
-                    where annotation.textValue like :tag"""
+                    where annotation.textValue like :{parameter}""".format(parameter=parameter)
 
 
 
@@ -172,22 +221,198 @@ class OMERO_Object:
 class OMERO_QualityCheck (OMERO_Object):
     "Base class for a quality check in OMERO"
 
+    # Cache of query results: (query, parameters) -> (timestamp, version, ids)
+    # Shared by every quality check in the process, entries expire after 
+    # 'query_ttl' seconds and are invalidated whenever an image is tagged, so 
+    # only repeated queries with no tagging in between hit the cache
+    _query_cache = {}
+    _query_version = 0
+    query_ttl = 60
+    
+    # '#noqc_<channel>' tags of every image in the current run(), by image ID
+    _ann_cache = {}
 
     def run (self, *args, **kwargs):
         "Pattern for running quality checks"
-        for objectid in self.query(without_tag=self.name):
-            result = self.check(objectid)
-            self.store(objectid, result)
+        ids = self.query()
+        self._ann_cache = self._prefetch_annotations(ids)
+        
+        # Checks are independent and mostly wait on pixel fetches, so run them 
+        # on a pool of worker threads and store the results as they come back.
+        # A failed check is logged and leaves only that image untagged. A failed 
+        # store is logged too, but fails the run once every image has been tried, 
+        # and programming errors in store() stop the run straight away
+        failed = []
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for objectid, (ok, result) in zip(ids, executor.map(self._check, ids)):
+                    if not ok: 
+                        continue
+                    try:
+                        self.store(objectid, result)
+                    except (AttributeError, TypeError, NameError):
+                        executor.shutdown(wait=False, cancel_futures=True)
+                        raise
+                    except Exception:
+                        logger.exception("%s: storing results for image %s failed", self.name, unwrap(objectid))
+                        failed.append(unwrap(objectid))
+        finally:
+            # Close the sessions the worker threads opened, keeping this thread's
+            self.close_connections(keep=self.conn)
+        
+        if failed:
+            raise RuntimeError("{name}: storing results failed for {n} of {total} images: {ids}".format(
+                                name=self.name, n=len(failed), total=len(ids), ids=failed))
+
+    def _check (self, objectid):
+        "Run check() on one image, returning (succeeded, result) instead of raising"
+        try:
+            return True, self.check(objectid)
+        except Exception:
+            logger.exception("%s: check of image %s failed", self.name, unwrap(objectid))
+            return False, None
+
+    def _prefetch_annotations (self, ids):
+        "Fetch the '#noqc_<channel>' tags of the images 'ids', page_size images per query"
+        annotations = dict((unwrap(objectid), []) for objectid in ids)
+        
+        # '_' is a wildcard in like, so it is escaped to match literally
+        query = """
+select img.id, ann.textValue from Image img
+join img.annotationLinks as links
+join links.child as ann
+where img.id in (:ids)
+and ann.textValue like :noqc escape '!'
+"""
+        queryService = self.getQueryService()
+        for start in range(0, len(ids), self.page_size):
+            params = omero.sys.ParametersI()
+            params.addIds(ids[start:start + self.page_size])
+            params.add('noqc', rstring("#noqc!_%"))
+            for row in queryService.projection(query, params):
+                imageid, text = unwrap(row)
+                annotations.setdefault(imageid, []).append(text)
+        return annotations
+
+    def _get_image_info (self, imageid):
+        """
+        Fetch an image with its pixels and channels eagerly in a single query
+        
+        Returns the pixels wrapper, the channel labels and the (Z,C,T,Y,X) sizes
+        """
+        params = omero.sys.ParametersI()
+        params.addId(imageid)
+        query = """
+select image from Image image
+left outer join fetch image.pixels as pixels
+left outer join fetch pixels.pixelsType
+left outer join fetch pixels.channels as channel
+left outer join fetch channel.logicalChannel
+where image.id = :id
+"""
+        image = self.getQueryService().findByQuery(query, params)
+        pixels = image.getPrimaryPixels()
+        
+        # Label channels like ChannelWrapper.getLabel(): by name, else by emission 
+        # or excitation wavelength, else by index
+        labels = []
+        for index, channel in enumerate(pixels.copyChannels()):
+            logicalChannel = channel.getLogicalChannel()
+            label = unwrap(logicalChannel.getName())
+            if not label:
+                waves = (logicalChannel.getEmissionWave(), logicalChannel.getExcitationWave())
+                waves = [ wave.getValue() for wave in waves if wave is not None ]
+                label = str(int(waves[0])) if waves else str(index)
+            labels.append(label)
+        
+        sizes = tuple(unwrap(size) for size in (pixels.getSizeZ(), pixels.getSizeC(), pixels.getSizeT(), 
+                                                pixels.getSizeY(), pixels.getSizeX()))
+        return omero.gateway.PixelsWrapper(self.conn, pixels), labels, sizes
+
+    def skipped_channels (self, imageid):
+        "Labels of the channels of an image opted out of quality checks with a '#noqc_<channel>' tag"
+        return set( text[len("#noqc_"):] for text in self._ann_cache.get(unwrap(imageid), []) 
+                    if text.startswith("#noqc_") )
+
+    def prefetch_planes (self, pixels, zct_list, depth=2):
+        """
+        Yield the planes in 'zct_list' while a background thread fetches ahead, 
+        so the next plane comes over the network while the current one is processed
+        
+        The background thread uses the connection of 'pixels' for as long as the 
+        generator runs, so the caller must not use that connection until the 
+        generator is exhausted or closed. The connection is then handed back, 
+        and is never used by two threads at once.
+        """
+        planes = queue.Queue(maxsize=depth)
+        stop = threading.Event()
+        done = object()
+        
+        def producer ():
+            fetched = None
+            try:
+                fetched = pixels.getPlanes(zct_list)
+                for plane in fetched:
+                    if stop.is_set():
+                        break
+                    planes.put((plane, None))
+            except Exception as e:
+                planes.put((None, e))
+            finally:
+                # Closes the raw pixels store
+                if fetched is not None:
+                    fetched.close()
+                # End of stream, so the consumer never waits on a finished producer
+                planes.put(done)
+        
+        fetcher = threading.Thread(target=producer, daemon=True)
+        fetcher.start()
+        try:
+            for count in range(len(zct_list)):
+                item = planes.get()
+                if item is done:
+                    raise IOError("getPlanes() stopped after {count} of {total} planes".format(count=count, total=len(zct_list)))
+                plane, error = item
+                if error is not None:
+                    raise error
+                yield plane
+        finally:
+            # If the caller stopped early the producer may be blocked on a full 
+            # queue, so keep draining it until the producer has finished
+            stop.set()
+            while fetcher.is_alive():
+                try:
+                    planes.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            fetcher.join()
+
+    def link_annotations (self, image, annotations):
+        "Save and link a list of annotation wrappers to an image proxy in a single call"
+        links = []
+        for annotation in annotations:
+            link = omero.model.ImageAnnotationLinkI()
+            link.setParent(image)
+            link.setChild(annotation._obj)
+            links.append(link)
+        self.getUpdateService().saveArray(links)
 
     @classmethod
     def autotag (cls, f):
-        "Decorator for automatically tagging images with the QC name during store()"
+        """
+        Decorator for automatically tagging images with the QC name during store()
+        
+        The decorated store() is given an unloaded image proxy instead of the image 
+        ID, and returns the annotations it created, which are linked to the image 
+        together with the tag in a single call.
+        """
         def wrapper (self, objectid, result):
+            image = omero.model.ImageI(objectid, False)
             tagAnn = omero.gateway.TagAnnotationWrapper(self.conn)
             tagAnn.setValue(self.name)
-            tagAnn.save()
-            self.conn.getObject("Image", objectid).linkAnnotation(tagAnn)
-            f(self, objectid, result)
+            annotations = f(self, image, result) or []
+            self.link_annotations(image, [tagAnn] + list(annotations))
+            OMERO_QualityCheck._query_version += 1
         return wrapper
 
     @property
@@ -234,9 +459,23 @@ and plate not in (      select p from Plate p
                         where annotation.textValue like :noqc )
 """
 
+        # Return cached results if the same query was run recently
+        now = time.time()
+        key = (query, tuple(sorted((k, unwrap(v)) for k,v in params.map.items())))
+        cached = self._query_cache.get(key)
+        if cached is not None and now - cached[0] < self.query_ttl and cached[1] == self._query_version:
+            return list(cached[2])
+        
         results = queryService.findAllByQuery(query, params)
         ids = [ obj.id for obj in results ]
-        return ids
+        
+        # Drop expired or invalidated entries, then store this one in place of 
+        # any older result for the same key
+        for stale in [ k for k,(timestamp, version, _) in self._query_cache.items() 
+                       if now - timestamp >= self.query_ttl or version != self._query_version ]:
+            self._query_cache.pop(stale, None)
+        self._query_cache[key] = (now, self._query_version, ids)
+        return list(ids)
         
     def remove (self, obj):
         "Remove all quality check tags from 'obj' from the current namespace"
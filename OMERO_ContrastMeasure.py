@@ -7,6 +7,7 @@ from omero.gateway import BlitzGateway
 from omero.rtypes import rlong, robject, rstring, rfloat, wrap, unwrap
 
 import sys
+import math
 import itertools
 import numpy as np
 
@@ -16,41 +17,45 @@ from OMERO_BaseClasses import OMERO_QualityCheck
 class OMERO_ContrastMeasure (OMERO_QualityCheck):
 
     qc_name = "ContrastMeasure"
-    qc_version = 0.1
+    qc_version = 0.2
+    
+    # Only about every n-th pixel of a plane is used to estimate its quartiles.
+    # The actual stride is the smallest value >= sample_stride that is coprime 
+    # to the plane width, so successive rows sample different columns instead 
+    # of the same column grid
+    sample_stride = 16
 
     def check (self, imageid):
-        image = self.conn.getObject("Image", imageid)
-        pixels = image.getPrimaryPixels()
-        labels = image.getChannelLabels()
-        planes_zct = itertools.product( range(image.getSizeZ()), 
-                                        range(image.getSizeC()), 
-                                        range(image.getSizeT())) 
+        pixels, labels, (sizeZ, sizeC, sizeT, _, columns) = self._get_image_info(imageid)
+        stride = self.sample_stride
+        while math.gcd(stride, columns) != 1:
+            stride += 1
+        skipped = self.skipped_channels(imageid)
+        zct_list = [ (z,c,t) for z,c,t in itertools.product(range(sizeZ), range(sizeC), range(sizeT)) 
+                     if labels[c] not in skipped ]
         results = []
-        for zct in planes_zct:
-            z,c,t = zct
-            plane = pixels.getPlane(theZ=z, theC=c, theT=t) 
-            plane.resize((1, plane.size))
+        for (z,c,t), plane in zip(zct_list, self.prefetch_planes(pixels, zct_list)):
             label = labels[c] + " contrast"
-            if np.abs(np.percentile(plane, 50)) < 1e-5:
+            q25, q50, q75 = np.percentile(plane.ravel()[::stride], [25, 50, 75])
+            if abs(q50) < 1e-5:
                 contrast = "divide by zero"
             else: 
-                contrast = (np.percentile(plane, 75) - np.percentile(plane, 25)) / np.percentile(plane, 50)
+                contrast = (q75 - q25) / q50
             results.append([ label, str(contrast) ])
         
         return results
 
     @OMERO_QualityCheck.autotag
-    def store (self, imageid, results):
+    def store (self, image, results):
         # Init the map (key-value) annotation
         mapAnn = omero.gateway.MapAnnotationWrapper(self.conn)
         
         # Create a key/value pair for this check
         mapAnn.setNs(self.namespace)
         mapAnn.setValue(results)
-        mapAnn.save()
         
-        # Link the annotation to the image
-        self.conn.getObject("Image", imageid).linkAnnotation(mapAnn)
+        # Return the annotation to be linked to the image
+        return [ mapAnn ]
 
 
 if __name__ == "__main__":
@@ -6,22 +6,46 @@ import omero.scripts as scripts
 from omero.gateway import BlitzGateway
 from omero.rtypes import rlong, robject, rstring, wrap, unwrap
 
+import io
 import os
 import sys
-import math
-import tempfile
+import json
 import itertools
 
 import numpy as np
+import scipy.fft
+
+import matplotlib
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 
-from PIL import Image
-from cStringIO import StringIO
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 
 from OMERO_BaseClasses import OMERO_QualityCheck
 
 
+if njit is not None:
+    # Serial on purpose: check() already runs on several pool threads, and a 
+    # parallel kernel called from them at once is not safe with numba's 
+    # default threading layer. No fastmath either, since the log power is -inf 
+    # wherever the power is 0 and the sums must match np.bincount exactly
+    @njit("float64[:](float32[::1], int32[::1], int64)", cache=True)
+    def radial_sum (power, bin_idx, nbins):
+        "Sum a flattened power spectrum into its distance bins"
+        sums = np.zeros(nbins)
+        for i in range(power.size):
+            sums[bin_idx[i]] += power[i]
+        return sums
+else:
+    def radial_sum (power, bin_idx, nbins):
+        "Sum a flattened power spectrum into its distance bins"
+        return np.bincount(bin_idx, weights=power, minlength=nbins)
+
+
 
 class OMERO_PowerSpectrum (OMERO_QualityCheck):
     """
@@ -29,99 +53,145 @@ class OMERO_PowerSpectrum (OMERO_QualityCheck):
     """
     
     qc_name = "PowerSpectrum"
-    qc_version = 0.1
+    qc_version = 0.2
+    
+    # Number of planes transformed together in one FFT call
+    fft_chunk = 8
+    
+    # Cache of (rows, columns) -> (bin_idx, counts) from _build_bins()
+    _bin_cache = {}
 
-    def check (self, imageid):
-        image = self.conn.getObject("Image", imageid)
-        pixels = image.getPrimaryPixels()
-        labels = image.getChannelLabels()
-        planes_zct = itertools.product( range(image.getSizeZ()), 
-                                        range(image.getSizeC()), 
-                                        range(image.getSizeT()))
-        
-        rows = image.getSizeY()
-        columns = image.getSizeX()
-        
-        midrow = int(math.ceil(0.5 * rows)) 
-        midcol = int(math.ceil(0.5 * columns)) 
-        midpoint = (midrow, midcol) 
-        
+    @staticmethod
+    def _build_bins (rows, columns):
+        "Radial distance bin of every power spectrum pixel, and the pixel count of each bin"
         # Change of variables for computing distance form the midpoint
-        # Let f = (w/2) - |x - (w/2)| 
-        #     g = (h/2) - |y - (h/2)|
-        def distance (y, x): 
-            return np.linalg.norm(np.array((midcol - abs(x - midcol), 
-                                            midrow - abs(y - midrow)))) 
+        # Let f = min(x, w - x)
+        #     g = min(y, h - y)
+        # so the four corners of the (unshifted) FFT all map to the origin.
+        # The real FFT only keeps the (w//2 + 1) non-negative x frequencies
+        yy, xx = np.ogrid[:rows, :columns//2 + 1]
+        dy = np.minimum(yy, rows - yy)
+        dx = np.minimum(xx, columns - xx)
         
-        # Index the pixels by (x,y) location
-        indexes = tuple(itertools.product(range(rows), range(columns)))
+        # These distances are by pixel-index, so they will be the same for each 
+        # plane. So pre-compute a single flat array with the integer distance bin 
+        # of every pixel, and the number of pixels that fall into each bin
+        bin_idx = np.sqrt(dx*dx + dy*dy).astype(np.int32).ravel()
+        counts = np.bincount(bin_idx)
+        return bin_idx, counts
+
+    def check (self, imageid):
+        pixels, labels, (sizeZ, sizeC, sizeT, rows, columns) = self._get_image_info(imageid)
+        skipped = self.skipped_channels(imageid)
         
-        # Calculate the distance from each pixel to the center
-        distances = tuple(itertools.starmap(distance, indexes))
-        maxdistance = np.ceil(max(distances)).astype(int)
+        # Order the planes channel by channel, so that all the (z,t) planes of 
+        # one channel arrive together and can be transformed in stacks
+        zt_list = list(itertools.product(range(sizeZ), range(sizeT)))
+        zct_list = [ (z,c,t) for c in range(sizeC) if labels[c] not in skipped 
+                             for z,t in zt_list ]
         
-        # These distances are by pixel-index, so they will be the same for each 
-        # plane. So pre-compute which pixels should be grouped together by distance 
-        distance_groups = []
-        for i,(a,b) in enumerate(zip(range(maxdistance-1), range(1, maxdistance))):
-            interval = lambda x: a < x and x <= b
-            distance_groups.append(map(interval, distances))
+        # The distance bins only depend on the plane shape, so they are shared 
+        # by every image of the same size
+        bins = self._bin_cache.get((rows, columns))
+        if bins is None:
+            bins = self._bin_cache[(rows, columns)] = self._build_bins(rows, columns)
+        bin_idx, counts = bins
+        
+        # Share the cores between the pool threads running checks at once
+        fft_workers = max(1, (os.cpu_count() or 1) // self.workers)
         
-        # Iterate through each plane in the (z,c,t) list and compute power spectrum 
+        # Iterate through each channel and compute its power spectrum, one chunk 
+        # of planes at a time while the next chunk is prefetched
         results = {}
-        for zct in planes_zct:
-            z,c,t = zct
-            plane = pixels.getPlane(theZ=z, theC=c, theT=t)
+        scratch = {}
+        planes = zip(zct_list, self.prefetch_planes(pixels, zct_list, depth=self.fft_chunk))
+        for c, group in itertools.groupby(planes, key=lambda item: item[0][1]):
+            group = (plane for _, plane in group)
+            total = np.zeros((rows, columns//2 + 1), dtype=np.float32)
+            nplanes = 0
             
-            # Compute the (log) power spectrum for the correspoding plane
-            powerspectrum = np.log10(np.abs(np.fft.fft2(plane))**2)
-            powerspectrum = powerspectrum.reshape(1,powerspectrum.size)[0]
+            for chunk in iter(lambda: list(itertools.islice(group, self.fft_chunk)), []):
+                stack = np.stack([ np.asarray(plane, dtype=np.float32) for plane in chunk ])
+                
+                # Compute the (log) power spectrum for every plane of the chunk at once
+                spectrum = scipy.fft.rfft2(stack, axes=(-2,-1), workers=fft_workers)
+                # The squares go into buffers reused across chunks and channels, 
+                # one pair per chunk shape (the last chunk may be shorter)
+                if spectrum.shape not in scratch:
+                    scratch[spectrum.shape] = (np.empty(spectrum.shape, dtype=np.float32), 
+                                               np.empty(spectrum.shape, dtype=np.float32))
+                powerspectrum, imag2 = scratch[spectrum.shape]
+                np.square(spectrum.real, out=powerspectrum)
+                np.square(spectrum.imag, out=imag2)
+                powerspectrum += imag2
+                np.log10(powerspectrum, out=powerspectrum)
+                
+                # Keep a running sum over all the planes of the channel
+                total += powerspectrum.sum(axis=0)
+                nplanes += len(chunk)
             
-            # Radial averaging
-            radial_average = []
-            for distance_group in distance_groups:
-                radial_average.append(np.mean(tuple(itertools.compress(powerspectrum, distance_group))))
+            # Radial averaging over all the planes of the channel
+            sums = radial_sum(total.ravel(), bin_idx, counts.size)
+            radial_average = sums / np.maximum(counts * nplanes, 1)
             
-            # Store result
-            results[labels[c]] = radial_average
+            # Store result, quantized to half precision since it is only a QC curve
+            results[labels[c]] = radial_average.astype(np.float16)
         
         return results
     
+    @property
+    def _figure (self):
+        "Figure and axes for the power spectrum plots, created once and reused"
+        if not hasattr(self, '_figure_axes'):
+            self._figure_axes = plt.subplots()
+        return self._figure_axes
+    
+    @staticmethod
+    def _to_json (result):
+        "Strict JSON list of a radial average, with non-finite values (log of a zero power) as null"
+        return json.dumps([ float(value) if np.isfinite(value) else None for value in np.asarray(result).tolist() ], 
+                          allow_nan=False)
+    
     @OMERO_QualityCheck.autotag
-    def store (self, imageid, results):
+    def store (self, image, results):
         """
         Store power spectrum data
-            - Store numerical values in as a double annotation attached to the image
+            - Store numerical values as a map annotation attached to the image,
+              one (channel, JSON list) pair per channel, with null for -inf/nan
             - Store plots of the power spectrum as PNG files attached to the image
         """
+        # Create a single map (key-value) annotation for the results of all channels
+        mapAnn = omero.gateway.MapAnnotationWrapper(self.conn)
+        mapAnn.setNs(self.namespace)
+        mapAnn.setValue([ [label, self._to_json(result)] for label,result in results.items() ])
+        annotations = [ mapAnn ]
+        
         for label,result in results.items():
-            # Create a "double" annotation for the results
-            doubleAnn = omero.gateway.DoubleAnnotationWrapper(self.conn)
-            doubleAnn.setName(label + " power spectrum")
-            doubleAnn.setNs(self.namespace)
-            doubleAnn.setValue(results)
-            self.conn.getObject("Image", imageid).linkAnnotation(doubleAnn)
-            
-            # Plot the data
-            plt.plot(result)
-            plt.title(label + " Power Spectrum")
+            # Plot the data, reusing the same figure for every channel
+            figure, axes = self._figure
+            axes.clear()
+            axes.plot(result)
+            axes.set_title(label + " Power Spectrum")
             
             # Prep label
             label = label.replace(' ','_')
             
-            # Create a temporary file named after the channel label
-            _f, filename = tempfile.mkstemp(prefix=label + "_", suffix='_powerspectrum.png')
-            
-            # Save the image
-            plt.savefig(filename, bbox_inches='tight')
-            plt.close()
+            # Render the image in memory, named after the channel label
+            filename = label + "_powerspectrum.png"
+            buffer = io.BytesIO()
+            figure.savefig(buffer, format='png', bbox_inches='tight')
+            size = buffer.tell()
+            buffer.seek(0)
             
-            # Create a file annotation and link it to the image
-            fileAnn = self.conn.createFileAnnfromLocalFile(filename, mimetype="image/png", ns=self.namespace, desc=None)
-            self.conn.getObject("Image", imageid).linkAnnotation(fileAnn)
-            
-            # Remove the tmp file
-            os.remove(filename)
+            # Upload it and create a file annotation for it
+            originalFile = self.conn.createOriginalFileFromFileObj(buffer, "", filename, size, mimetype="image/png", ns=self.namespace)
+            fileAnn = omero.gateway.FileAnnotationWrapper(self.conn)
+            fileAnn.setFile(originalFile)
+            fileAnn.setNs(self.namespace)
+            annotations.append(fileAnn)
+        
+        # Return the annotations to be linked to the image
+        return annotations
 
 
 if __name__ == "__main__":
@@ -30,17 +30,16 @@ class OMERO_SaturationCheck (OMERO_QualityCheck):
         return results
 
     @OMERO_QualityCheck.autotag
-    def store (self, imageid, results):
+    def store (self, image, results):
         # Init the map (key-value) annotation
         mapAnn = omero.gateway.MapAnnotationWrapper(self.conn)
         
         # Create a key/value pair for this check
         mapAnn.setNs(self.namespace)
         mapAnn.setValue(results)
-        mapAnn.save()
         
-        # Link the annotation to the image
-        self.conn.getObject("Image", imageid).linkAnnotation(mapAnn)
+        # Return the annotation to be linked to the image
+        return [ mapAnn ]
 
 
 if __name__ == "__main__":